@@ -1,11 +1,18 @@
 #!/bin/python3
-import os, argparse, sys, json
+import os, argparse, sys, json, errno
 from pathlib import Path
 from dataclasses import dataclass
-from filecmp import cmp as filecmp
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import hashlib
+import mmap
+import re
 import subprocess
-from shutil import copy2, rmtree
+import shlex
+from shutil import copy2, copystat, rmtree, which
+try:
+    import pyvips
+except ImportError: # only needed for --backend vips
+    pyvips = None
 
 def command_line_args():
     parser = argparse.ArgumentParser(
@@ -22,6 +29,9 @@ def command_line_args():
     parser.add_argument("-r", "--remove-old",
       help="Delete unnecessary files in DEST?",
       default=False, action='store_true')
+    parser.add_argument("--backend",
+      help="Derive the images by running ImageMagick or in-process with libvips (needs pyvips)",
+      choices=['magick', 'vips'], default='magick')
     parser.add_argument("--dry-run",
       help="Prints actions but doesn't take them",
       default=False, action='store_true')
@@ -30,9 +40,9 @@ def command_line_args():
       default=False, action='store_true')
     return parser.parse_args()
 
-def take_action(action, description):
+def take_action(action, description, log=print):
     if args.verbose or args.dry_run:
-        print(f"-{description}")
+        log(f"-{description}")
     if not args.dry_run:
         action()
 
@@ -45,22 +55,79 @@ def prepare_dest(dest, remove_old):
             exit(1)
         if remove_old:
             global files_to_rm
-            files_to_rm = set(map(lambda p: p.resolve(), dest.iterdir()))
+            files_to_rm = {os.path.join(dest, name) for name in os.listdir(dest)}
     else:
         take_action(lambda:args.dest.mkdir(), f"mkdir {str(args.dest)}")
 
 def touch_file(path):
-    """Returns True if the file was in `files_to_rm`"""
+    """
+    Returns True if the file was in `files_to_rm`
+
+    Paths are matched with `os.path.abspath` (a pure string op, no stat)
+    so `path` must be built under the resolved `args.dest`
+    """
     try:
-        files_to_rm.remove(Path(path).resolve())
+        files_to_rm.remove(os.path.abspath(path))
         return True
     except KeyError:
         return False
 
+def file_digest(path):
+    """Returns the blake2b digest of the (non-empty) file at `path`"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return hashlib.blake2b(buf).digest()
+
+def files_match(frompath, topath, to_st=None):
+    """
+    Compares file contents: sizes first, then digests
+
+    Pass `topath`'s `os.stat` as `to_st` if you already have it
+    """
+    from_st = frompath.stat()
+    if to_st is None:
+        to_st = topath.stat()
+    if from_st.st_size != to_st.st_size:
+        return False
+    if from_st.st_size == 0: # can't mmap an empty file
+        return True
+    return file_digest(frompath) == file_digest(topath)
+
+def kernel_copy(frompath, topath):
+    """
+    Like copy2, but has the kernel copy the data with `os.copy_file_range`
+    (which reflinks on filesystems that support it)
+    falling back to copy2 where it isn't available
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return copy2(frompath, topath)
+    try:
+        with open(frompath, 'rb') as src, open(topath, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                if not n:
+                    break
+                copied += n
+    except OSError as e:
+        # e.g. across filesystems on older kernels
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        return copy2(frompath, topath)
+    if copied != size:
+        # some filesystems report a short copy as 0 rather than an error
+        return copy2(frompath, topath)
+    copystat(frompath, topath)
+
 def copy_file(frompath, topath):
-    if topath.exists():
+    # one stat serves as both the existence check and files_match's size check
+    try:
+        to_st = topath.stat()
+    except FileNotFoundError:
+        to_st = None
+    if to_st is not None:
         touch_file(topath)
-        if filecmp(str(frompath), str(topath), shallow=False):
+        if files_match(frompath, topath, to_st):
           if args.verbose:
             print(f"{str(topath)}: already correct")
           return
@@ -68,28 +135,61 @@ def copy_file(frompath, topath):
           lambda:topath.unlink(),
           f"rm {str(topath)}")
     take_action(
-      lambda:copy2(frompath,topath),
+      lambda:kernel_copy(frompath,topath),
       f"cp {str(frompath)} {str(topath)}")
 
 def remove_untouched_files():
   if len(files_to_rm)>0:
     for file in files_to_rm:
-      rm_file(file)
+      rm_file(Path(file))
 
-def rm_file(file):
+def rm_file(file, log=print):
   if file.is_dir():
-    take_action(lambda:rmtree(file), f"rm -rf {str(file)}")
+    take_action(lambda:rmtree(file), f"rm -rf {str(file)}", log=log)
   else:
-    take_action(lambda:file.unlink(), f"rm {str(file)}")
+    take_action(lambda:file.unlink(), f"rm {str(file)}", log=log)
+
+async def run_process(cmd, stdout=asyncio.subprocess.PIPE):
+    """
+    Runs `cmd` to completion, returning its (returncode, stdout, stderr)
+
+    Kills the process if cancelled, so it can't outlive the build
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=stdout, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout, stderr
+
+async def gather_all(*aws):
+    """
+    Like asyncio.gather, but lets every awaitable finish before raising the first error
+    (so no sibling keeps writing into DEST after the build has failed)
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
 
 @dataclass(frozen=True)
 class ImageVariant:
-    command: str
+    argv: tuple[str, ...]
     outpath: str
 
+def round_div(n, d):
+    """Returns round(n / d) (rounding half to even, like round) without the float division"""
+    q, r = divmod(n, d)
+    if 2*r > d or (2*r == d and q % 2):
+        q += 1
+    return int(q)
+
 def magick_resize(width: int, height: int, target_width: int, target_height: int, center_x, center_y):
     """
-    Returns an imagemagick command for resizing an image buffer
+    Returns imagemagick arguments for resizing an image buffer
     from `width` x `height` to `target_width` x `target_height`
     focusing on the given center point
     
@@ -98,39 +198,145 @@ def magick_resize(width: int, height: int, target_width: int, target_height: int
     - center is in percentage points (i.e. 50 is the middle)
     
     Returns:
-    A string giving the -resize command without any additional IO ops
+    A tuple of argv giving the -resize command without any additional IO ops
     """
-    target_ratio = float(target_width) / float(target_height)
-    actual_ratio = float(width) / float(height)
+    # compare target_width/target_height against width/height by cross-multiplying
+    wider = target_width * height - width * target_height
     crop_width = width
     crop_height = height
     crop_x = 0
     crop_y = 0
-    if target_ratio > actual_ratio: # Wider target => trim top/bottom
-        crop_height = round(height * actual_ratio / target_ratio)
+    if wider > 0: # Wider target => trim top/bottom
+        crop_height = round_div(width * target_height, target_width)
         delta_h = height - crop_height
-        crop_y = round(delta_h * center_y / 100.0)
-    if target_ratio < actual_ratio: # Taller target => trim sides
-        crop_width = round(width * target_ratio / actual_ratio)
+        crop_y = round_div(delta_h * center_y, 100)
+    if wider < 0: # Taller target => trim sides
+        crop_width = round_div(height * target_width, target_height)
         delta_w = width - crop_width
-        crop_x = round(delta_w * center_x / 100.0)
-    ret = ""
+        crop_x = round_div(delta_w * center_x, 100)
+    ret = ()
     if crop_height != height or crop_width != width:
-        ret = f"-crop '{crop_width}x{crop_height}+{crop_x}+{crop_y}' +repage "
+        ret = ('-crop', f'{crop_width}x{crop_height}+{crop_x}+{crop_y}', '+repage')
     if target_height != crop_height or target_width != crop_width:
-        ret += f"-resize '{target_width}x{target_height}>'"
+        ret += ('-resize', f'{target_width}x{target_height}>')
     return ret
 
+# offsets may be negative, including the `+-12` that an f'+{x}' gives for x = -12
+MAGICK_GEOMETRY = re.compile(r'(\d+)(?:x(\d+))?(?:(\+-?\d+|-\d+)(\+-?\d+|-\d+))?(>?)')
+VIPS_MAX_COORD = 10000000
+
+def parse_magick_geometry(geometry):
+    """
+    Parses an ImageMagick geometry like `640x480+10-5>`
+
+    Returns (width, height or None, x, y, shrink_only)
+    """
+    match = MAGICK_GEOMETRY.fullmatch(geometry)
+    if match is None:
+        raise ValueError(f"The vips backend can't parse the geometry {geometry!r}")
+    width, height, x, y, shrink_only = match.groups()
+    return (int(width), int(height) if height else None,
+        int(x.lstrip('+')) if x else 0, int(y.lstrip('+')) if y else 0,
+        bool(shrink_only))
+
+def vips_apply(orig, image, argv):
+    """
+    Applies the ImageMagick ops in `argv` to the pyvips `image`
+
+    Only the ops that the derivers use are understood:
+    `+delete mpr:orig` (start over from `orig`), `-crop`, `+repage` and `-resize`
+    """
+    argv = iter(argv)
+    for op in argv:
+        match op, (next(argv) if op in ('+delete', '-crop', '-resize') else None):
+            case '+delete', 'mpr:orig':
+                image = orig
+            case '+repage', None:
+                pass # vips images have no virtual canvas to reset
+            case '-crop', geometry:
+                width, height, x, y, _ = parse_magick_geometry(geometry)
+                # ImageMagick clips the crop to the image, where vips would raise
+                left, top = max(x, 0), max(y, 0)
+                right = min(x + width, image.width)
+                bottom = min(y + (height or image.height), image.height)
+                if right <= left or bottom <= top:
+                    raise ValueError(f"-crop {geometry} misses the {image.width}x{image.height} image entirely")
+                image = image.crop(left, top, right - left, bottom - top)
+            case '-resize', geometry:
+                width, height, _, _, shrink_only = parse_magick_geometry(geometry)
+                image = image.thumbnail_image(width,
+                    height=height or VIPS_MAX_COORD,
+                    size='down' if shrink_only else 'both')
+            case _:
+                raise ValueError(f"The vips backend doesn't support {op}")
+    return image
+
+def check_magick_bin(magick_bin):
+    """Returns why `magick_bin` can't be used as MAGICK_BIN (or None if it can)"""
+    argv = magick_bin.split()
+    if not argv:
+        return "MAGICK_BIN is empty"
+    if os.path.basename(argv[0]) == 'gm':
+        # its convert has no image-list ops and every batch relies on them
+        return f"MAGICK_BIN={magick_bin!r}: GraphicsMagick isn't supported (no -delete or mpr:), use ImageMagick's convert or magick"
+    return None
+
+def magick_argv(magick_bin):
+    """Splits `magick_bin` into an argv prefix, looking its executable up on $PATH once up front"""
+    argv = magick_bin.split()
+    if not argv:
+        return () # check_magick_bin rejects this in __main__
+    executable, *rest = argv
+    return (which(executable) or executable, *rest)
+
+def vips_sizes(paths):
+    """Returns {path: (width, height)} for `paths`, reading only their headers with libvips"""
+    ret = {}
+    for path in paths:
+        image = pyvips.Image.new_from_file(path) # lazy: doesn't decode the pixels
+        ret[path] = (image.width, image.height)
+    return ret
+
+def identify_bin_for(magick_argv):
+    """`convert` => `identify`, `magick` => `magick identify`"""
+    if not magick_argv:
+        return ()
+    *prefix, last = magick_argv
+    if os.path.basename(last) == 'convert':
+        return (*prefix, os.path.join(os.path.dirname(last), 'identify'))
+    return (*prefix, last, 'identify')
+
+def scaled_sizes(sizes, density):
+    """Returns a (size, 1x pixels, 2x pixels) tuple for each of `sizes` at `density`"""
+    return [(size, round(density*size), round(2*density*size)) for size in sizes]
+
 class BaseImageDeriver:
+    # e.g. MAGICK_BIN=magick for ImageMagick 7
+    MAGICK_BIN = os.environ.get('MAGICK_BIN', 'convert')
+    MAGICK_ARGV = magick_argv(MAGICK_BIN)
+    IDENTIFY_BIN = identify_bin_for(MAGICK_ARGV)
     # method is 0-6 = fast-quality
     # pass is number of passes to iteratively approach the target-psnr. Should be btw 3 and 7
     # strip removes metadata
-    MAGICK_OPTS = "-verbose -strip -define webp:method=6 -define webp:pass=5 -define webp:target-psnr=49"
+    # (-verbose gets added under --verbose)
+    MAGICK_OPTS = "-strip -define webp:method=6 -define webp:pass=5 -define webp:target-psnr=49"
+    # split once here rather than per file (and again by __init_subclass__ for each subclass)
+    MAGICK_OPTS_ARGV = tuple(MAGICK_OPTS.split())
+    # libvips has no target-psnr, so ask for a fixed quality instead; effort is its name for webp:method
+    VIPS_WEBP_OPTS = {'Q': 90, 'effort': 6, 'strip': True, 'preset': 'photo'}
+    # source images per convert: enough to amortize ImageMagick's startup,
+    # few enough that the semaphore balances the load and one bad file only sinks its own batch
+    FILES_PER_BATCH = 8
     METADATA_FILENAME = 'metadata.json'
     SRC = NotImplemented
     DST = NotImplemented
     VERSION = NotImplemented
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # so a subclass only has to override MAGICK_OPTS
+        cls.MAGICK_OPTS_ARGV = tuple(cls.MAGICK_OPTS.split())
+
     def __init__(self, root, dest, verbose=False, dry_run=False):
         self.source = (root/self.SRC).resolve()
         self.target = (dest/self.DST).resolve()
@@ -141,88 +347,293 @@ class BaseImageDeriver:
             self.previous_info = json.loads(self.metadata_path.read_text())
         except FileNotFoundError:
             self.previous_info = {'version': 0}
-        self.metadata = {'version': self.VERSION}
+        # the backends encode differently, so switching --backend rebuilds everything
+        self.metadata = {'version': self.VERSION, 'backend': args.backend}
         self.modified_files = []
+        self._sizes = {}
+        self._existing_outputs = set()
+        # {relative filename: [git blob id, width, height]} from the previous run
+        self._size_cache = self.previous_info.get('sizes', {})
+        self.metadata['sizes'] = {}
+
+    def _iter_source_entries(self):
+        with os.scandir(self.source) as entries:
+            yield from entries
+
+    def _iter_nested_source_entries(self):
+        """Yields the same files as `self.source.glob('*/*')` but as `os.DirEntry`s"""
+        for subdir in self._iter_source_entries():
+            if subdir.is_dir():
+                with os.scandir(subdir.path) as entries:
+                    yield from entries
 
     def getSourceFiles(self):
-        return self.source.iterdir()
+        return self._iter_source_entries()
 
     def getVariantsForImage(self, filename, width, height):
         raise NotImplementedError
 
     def versionMatches(self, inpath, outpath):
-        return self.previous_info['version'] >= self.VERSION
+        # metadata from before --backend existed was all built by ImageMagick
+        return self.previous_info['version'] >= self.VERSION and self.previous_info.get('backend', 'magick') == self.metadata['backend']
+
+    async def _git_blob_ids(self, sem):
+        """
+        Returns {relative filename: git blob id} for the unmodified files
+        that git tracks under `self.source` (or {} if it isn't a git checkout)
+
+        These come straight from git's index, so they cost next to nothing to read
+        and, unlike mtimes, survive the fresh checkout CI does on every run
+        """
+        git = ['git', '-C', str(self.source), 'ls-files', '-z']
+        try:
+            async with sem:
+                staged = await run_process([*git, '--stage'])
+                changed = await run_process([*git, '--modified', '--others'])
+        except FileNotFoundError: # no git
+            return {}
+        if staged[0] or changed[0]:
+            return {}
+        ret = {}
+        for entry in os.fsdecode(staged[1]).split('\0'):
+            if entry:
+                info, filename = entry.split('\t', 1)
+                ret[filename] = info.split()[1]
+        for filename in os.fsdecode(changed[1]).split('\0'):
+            ret.pop(filename, None)
+        return ret
 
-    def magickCmdForFile(self, file):
-        result = subprocess.run(f"identify -ping -format '[%w,%h]' \"{str(file)}\"",
-          shell=True, check=True, capture_output=True)
-        width, height = json.loads(result.stdout)
-        relfile = file.relative_to(self.source)
-        variants = self.getVariantsForImage(relfile, width, height)
-        cmd = ""
-        for variant in variants:
+    async def _prefetch_sizes(self, sem, files):
+        """
+        Reads the dimensions of all `files` (`os.DirEntry`s) with a single `identify` call
+        (rather than spawning one ImageMagick process per file)
+        or, with the vips backend, from their headers in-process
+
+        Files whose git blob id matches the previous run's metadata
+        reuse the cached dimensions and aren't identified at all
+        """
+        blob_ids = await self._git_blob_ids(sem)
+        keys = {}
+        to_identify = []
+        for file in files:
+            key = os.path.relpath(file.path, self.source)
+            blob_id = blob_ids.get(key)
+            keys[file.path] = (key, blob_id)
+            cached = self._size_cache.get(key)
+            if blob_id and cached and cached[0] == blob_id:
+                self._sizes[file.path] = tuple(cached[1:])
+            else:
+                to_identify.append(file.path)
+        if to_identify and args.backend == 'vips':
+            async with sem:
+                # off the event loop, so the other derivers keep going meanwhile
+                self._sizes.update(await asyncio.to_thread(vips_sizes, to_identify))
+        elif to_identify:
+            cmd = [*self.IDENTIFY_BIN, '-ping', '-format', '%i\t%w\t%h\n', *to_identify]
+            async with sem:
+                returncode, stdout, stderr = await run_process(cmd)
+            if returncode:
+                self.log(stderr.decode(errors='replace'))
+                raise subprocess.CalledProcessError(returncode, cmd)
+            for line in os.fsdecode(stdout).splitlines():
+                filename, width, height = line.rsplit('\t', 2)
+                # multi-frame images print one line per frame: keep the first
+                self._sizes.setdefault(filename, (int(width), int(height)))
+        for path, (key, blob_id) in keys.items():
+            if blob_id:
+                self.metadata['sizes'][key] = [blob_id, *self._sizes[path]]
+
+    def _outputExists(self, outpath):
+        if outpath.parent == self.target:
+            return str(outpath) in self._existing_outputs
+        return outpath.exists()
+
+    def pendingVariantsForFile(self, file):
+        """
+        Returns a (variant, outpath) pair for each of `file`'s variants
+        with outpath None for the ones that are already up to date
+        (or [] if they all are)
+        """
+        width, height = self._sizes[file.path]
+        relfile = Path(os.path.relpath(file.path, self.source))
+        ret = []
+        pending = False
+        for variant in self.getVariantsForImage(relfile, width, height):
             outpath = self.target/variant.outpath
             touch_file(outpath)
-            if outpath.exists():
+            if self._outputExists(outpath):
               if self.versionMatches(relfile, outpath):
+                ret.append((variant, None))
                 continue
               self.modified_files.append(outpath)
-            cmd += f" {variant.command} -write \"{str(outpath)}\""
-        if cmd == "":
+            ret.append((variant, outpath))
+            pending = True
+        return ret if pending else []
+
+    def magickCmdForFile(self, file):
+        cmd = []
+        # ops of up-to-date variants that a later variant may still build on
+        skipped = []
+        for variant, outpath in self.pendingVariantsForFile(file):
+            if variant.argv[:2] == ('+delete', 'mpr:orig'):
+                skipped = [] # starts over from the original anyway
+            if outpath is None:
+                skipped += variant.argv
+                continue
+            ops = [*skipped, *variant.argv]
+            if not cmd and ops[:2] == ['+delete', 'mpr:orig']:
+                del ops[:2] # nothing has touched the original yet
+            cmd += [*ops, '-write', str(outpath)]
+            skipped = []
+        if not cmd:
             return None
-        # ImageMagick requires that the last output file _not_ get the explicit " -write " command
-        return f"convert \"{str(file)}\" {self.MAGICK_OPTS}" + ' '.join(cmd.rsplit(' -write ', 1))
+        opts = self.MAGICK_OPTS_ARGV
+        if self.verbose:
+            opts = ('-verbose', *opts)
+        # stash the decoded source once, if a later variant restarts from it, rather than rereading the file
+        if 'mpr:orig' in cmd:
+            opts += ('-write', 'mpr:orig')
+        return [file.path, *opts, *cmd]
+
+    def magickCmdForBatch(self, cmds):
+        """
+        Chains the per-file `cmds` into a single `MAGICK_BIN` argv,
+        clearing the image list between files
+        """
+        cmd = [*self.MAGICK_ARGV]
+        for i, filecmd in enumerate(cmds):
+            if i:
+                cmd += ['-delete', '0--1']
+            cmd += filecmd
+        # ImageMagick requires that the last output file _not_ get the explicit -write command
+        del cmd[-2]
+        return cmd
+
+    async def _run_cmd(self, sem, cmd):
+        async with sem:
+            # stdout only carries -verbose output, so don't pipe it otherwise
+            returncode, stdout, stderr = await run_process(cmd,
+                stdout=asyncio.subprocess.PIPE if self.verbose else asyncio.subprocess.DEVNULL)
+        self.log(f"-{shlex.join(cmd)}")
+        if self.verbose or returncode:
+            # imagemagick often writes to stderr too
+            for output in (stdout, stderr):
+                if output:
+                    self.log(output.decode(errors='replace').rstrip('\n'))
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def vipsDeriveFile(self, path, variants):
+        """
+        Writes the (variant, outpath) pairs from `pendingVariantsForFile`
+        with libvips, decoding the source only once for all of them
+        """
+        orig = image = pyvips.Image.new_from_file(path)
+        for variant, outpath in variants:
+            image = vips_apply(orig, image, variant.argv)
+            if outpath is not None:
+                # render once so later variants resize this rather than redoing it
+                image = image.copy_memory()
+                image.webpsave(str(outpath), **self.VIPS_WEBP_OPTS)
+
+    async def _run_vips(self, sem, path, variants):
+        async with sem:
+            # libvips releases the GIL while it works
+            thread = asyncio.ensure_future(asyncio.to_thread(self.vipsDeriveFile, path, variants))
+            try:
+                await asyncio.shield(thread)
+            except asyncio.CancelledError:
+                # the thread can't be interrupted, so let it finish writing before giving up
+                await asyncio.wait([thread])
+                raise
+        self.log(f"-vips {path} => {' '.join(str(outpath) for _, outpath in variants if outpath)}")
+
+    async def _derive_with_vips(self, sem, files):
+        """Derives the variants of `files` in-process, one libvips pipeline per source image"""
+        jobs = ((file.path, variants) for file in files if (variants := self.pendingVariantsForFile(file)))
+        did_work = False
+        # a rolling window of tasks, rather than one per image up front
+        in_flight = set()
+        for path, variants in jobs:
+            did_work = True
+            if self.dry_run:
+                self.log(f"-vips {path} => {' '.join(str(outpath) for _, outpath in variants if outpath)}")
+                continue
+            if len(in_flight) >= 2*args.cores:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                if any(task.exception() for task in done):
+                    in_flight |= done # so gather_all raises it
+                    break # stop submitting as soon as one fails
+            in_flight.add(asyncio.create_task(self._run_vips(sem, path, variants)))
+        await gather_all(*in_flight)
+        return did_work
+
+    async def _derive_with_magick(self, sem, files):
+        """Derives the variants of `files` with batched ImageMagick commands"""
+        cmds = []
+        for file in files:
+            cmd = self.magickCmdForFile(file)
+            if cmd:
+                cmds.append(cmd)
+        batches = [self.magickCmdForBatch(cmds[i:i+self.FILES_PER_BATCH]) for i in range(0, len(cmds), self.FILES_PER_BATCH)]
+        if self.dry_run:
+            for cmd in batches:
+                self.log(f"-{shlex.join(cmd)}")
+        else:
+            await gather_all(*(self._run_cmd(sem, cmd) for cmd in batches))
+        return bool(cmds)
+
+    def log(self, text):
+        """Queues `text` up for this deriver's block of output"""
+        self._log.append(text)
+
+    async def run(self, sem):
+        """
+        Derives all the images for this deriver
+
+        `sem` bounds the number of ImageMagick processes (or vips pipelines) running at once
+        and may be shared with other derivers running concurrently,
+        so the output is printed in one block once this deriver is done
+        (or has failed) rather than interleaved with theirs
+        """
+        self._log = [f"\n======={self.__class__.__name__}========"]
+        try:
+            await self._run(sem)
+        finally:
+            print('\n'.join(self._log), flush=True)
 
-    def run(self):
-        print(f"\n======={self.__class__.__name__}========")
+    async def _run(self, sem):
         if self.verbose:
-            print(f"{ str(self.source) } => {str(self.target)}")
+            self.log(f"{ str(self.source) } => {str(self.target)}")
         if not self.source.is_dir():
-            print(f"{str(self.source)} is not a directory!")
+            self.log(f"{str(self.source)} is not a directory!")
             exit(1)
         if self.target.exists():
             if not self.target.is_dir():
-              rm_file(self.target)
-              print(f"Warning! {str(self.target)} was not a directory (and was overwritten)")
+              rm_file(self.target, log=self.log)
+              self.log(f"Warning! {str(self.target)} was not a directory (and was overwritten)")
             touch_file(self.target)
         take_action(
             lambda:self.target.mkdir(parents=True, exist_ok=True),
-            f"mkdir -p {str(self.target)}")
-        done = 0
-        if self.dry_run:
-            for file in self.getSourceFiles():
-                cmd = self.magickCmdForFile(file)
-                if cmd:
-                    print(f"-{cmd}")
-                    done += 1
+            f"mkdir -p {str(self.target)}", log=self.log)
+        # one readdir of the target up front, rather than a stat per output
+        try:
+            with os.scandir(self.target) as entries:
+                self._existing_outputs = {entry.path for entry in entries}
+        except FileNotFoundError: # dry run
+            self._existing_outputs = set()
+        files = list(self.getSourceFiles())
+        await self._prefetch_sizes(sem, files)
+        if args.backend == 'vips':
+            did_work = await self._derive_with_vips(sem, files)
         else:
-          with ThreadPoolExecutor(max_workers=args.cores) as executor:
-            futures = []
-            for file in self.getSourceFiles():
-              cmd = self.magickCmdForFile(file)
-              if cmd:
-                done += 1
-                futures.append(executor.submit(
-                    subprocess.run,
-                    cmd,
-                    shell=True,
-                    capture_output=True
-                ))
-            for future in as_completed(futures):
-                result = future.result()
-                print(f"-{result.args}", flush=True)
-                if self.verbose or result.returncode:
-                    sys.stdout.buffer.write(result.stdout)
-                    # imagemagick often writes to stderr too
-                    sys.stdout.buffer.write(result.stderr)
-                    sys.stdout.buffer.flush()
-                if result.returncode:
-                    raise subprocess.CalledProcessError(result.returncode, result.args)
+            did_work = await self._derive_with_magick(sem, files)
+        if not self.dry_run:
           take_action(lambda: self.metadata_path.write_text(json.dumps(self.metadata)),
-            f"Dumping {self.__class__.__name__}'s metadata to a json file...")
-        if done == 0:
-            print(f"Nothing to do :_)")
-        print(f"===Finished {self.__class__.__name__}===\n")
+            f"Dumping {self.__class__.__name__}'s metadata to a json file...", log=self.log)
+        if not did_work:
+            self.log(f"Nothing to do :_)")
+        self.log(f"===Finished {self.__class__.__name__}===\n")
 
 class ImageryCourseImageDeriver(BaseImageDeriver):
     SRC='../imgs/imagery'
@@ -232,8 +643,8 @@ class ImageryCourseImageDeriver(BaseImageDeriver):
     def getVariantsForImage(self, filename, width, height):
         retname = str(filename.with_suffix('.webp'))
         return [
-            ImageVariant("-resize '1066x1280>'", retname),
-            ImageVariant("-resize 533", retname.replace('.webp', '-1x.webp')),
+            ImageVariant(('-resize', '1066x1280>'), retname),
+            ImageVariant(('-resize', '533'), retname.replace('.webp', '-1x.webp')),
         ]
 
 class BuddhismCourseImageDeriver(BaseImageDeriver):
@@ -245,14 +656,14 @@ class BuddhismCourseImageDeriver(BaseImageDeriver):
         retname = str(filename.with_suffix('.webp'))
         if height > width and height >= 1536:
           return [
-            ImageVariant("-resize '1920x1920>'", retname),
-            ImageVariant("-resize '1280x1280>'", retname.replace('.webp', '-2x.webp')),
-            ImageVariant("-resize '640x640>'", retname.replace('.webp', '-1x.webp')),
+            ImageVariant(('-resize', '1920x1920>'), retname),
+            ImageVariant(('-resize', '1280x1280>'), retname.replace('.webp', '-2x.webp')),
+            ImageVariant(('-resize', '640x640>'), retname.replace('.webp', '-1x.webp')),
           ]
         else:
           return [
-            ImageVariant("-resize '1280x1280>'", retname),
-            ImageVariant("-resize '640x640>'", retname.replace('.webp', '-1x.webp')),
+            ImageVariant(('-resize', '1280x1280>'), retname),
+            ImageVariant(('-resize', '640x640>'), retname.replace('.webp', '-1x.webp')),
           ]
 
 class FunctionCourseImageDeriver(BuddhismCourseImageDeriver):
@@ -262,7 +673,6 @@ class FunctionCourseImageDeriver(BuddhismCourseImageDeriver):
 
 class TagIllustrationImageDeriver(BaseImageDeriver):
     SRC='../imgs/tags'
-    MAGICK_OPTS=BaseImageDeriver.MAGICK_OPTS+" -write mpr:orig"
     DST='tags'
     VERSION = 1
 
@@ -272,26 +682,25 @@ class TagIllustrationImageDeriver(BaseImageDeriver):
         self.metadata['image_data'] = json.loads(image_data_path.read_text())
 
     def getSourceFiles(self):
-        return self.source.glob('*/*')
+        return self._iter_nested_source_entries()
 
     def versionMatches(self, inpath, outpath):
-        return self.previous_info['version'] >= self.VERSION and self.previous_info['image_data'][inpath.name] == self.metadata['image_data'][inpath.name]
+        return super(TagIllustrationImageDeriver, self).versionMatches(inpath, outpath) and self.previous_info['image_data'][inpath.name] == self.metadata['image_data'][inpath.name]
 
     def getVariantsForImage(self, file, width, height):
         crop = self.metadata['image_data'][file.name]['center']
         crop[0] = round((width-448)*crop[0]/100.0)
         crop[1] = round((height-250)*crop[1]/100.0)
         return [
-            ImageVariant("-resize '1840x1250>'", file.stem+'.webp'),
-            ImageVariant("-resize '920x625>'", file.stem+'-1x.webp'),
+            ImageVariant(('-resize', '1840x1250>'), file.stem+'.webp'),
+            ImageVariant(('-resize', '920x625>'), file.stem+'-1x.webp'),
             ImageVariant(
-                f"+delete mpr:orig -crop '448x250+{crop[0]}+{crop[1]}'",
+                ('+delete', 'mpr:orig', '-crop', f'448x250+{crop[0]}+{crop[1]}'),
                 file.stem+'-preview.webp'
             ),
         ]
 
 class BannerImageDeriver(BaseImageDeriver):
-    MAGICK_OPTS=BaseImageDeriver.MAGICK_OPTS+" -write mpr:orig"
     SRC='banners'
     DST='banners'
     VERSION = 2
@@ -301,14 +710,25 @@ class BannerImageDeriver(BaseImageDeriver):
     # and all larger "target_widths" are skipped
     MIN_DPP_FOR_2X = 1.75
     # the above constants need to be kept in sync with obu/_data/banner.yml
+    TARGET_SIZES = scaled_sizes(TARGET_WIDTHS, DENSITY)
+    # banners are big and have up to 16 variants each
+    FILES_PER_BATCH = 2
 
     def __init__(self, root, dest, verbose=False, dry_run=False):
         super(BannerImageDeriver, self).__init__(root, dest, verbose=verbose, dry_run=dry_run)
         image_data_path = self.source/'image_metadata.json'
         self.metadata['image_data'] = json.loads(image_data_path.read_text())
+        self._scaled_heights = {}
 
     def versionMatches(self, inpath, outpath):
-        return self.previous_info['version'] >= self.VERSION and self.previous_info['image_data'][inpath.name] == self.metadata['image_data'][inpath.name]
+        return super(BannerImageDeriver, self).versionMatches(inpath, outpath) and self.previous_info['image_data'][inpath.name] == self.metadata['image_data'][inpath.name]
+
+    def getScaledHeightsForType(self, subfolder):
+        """Returns the (1x, 2x) pixel heights for banners in `subfolder`"""
+        if subfolder not in self._scaled_heights:
+            _, *heights = scaled_sizes([self.getHeightForType(subfolder)], self.DENSITY)[0]
+            self._scaled_heights[subfolder] = heights
+        return self._scaled_heights[subfolder]
 
     def getHeightForType(self, subfolder):
         match subfolder:
@@ -326,39 +746,44 @@ class BannerImageDeriver(BaseImageDeriver):
                 raise ValueError(f"Unexpected subfolder {subfolder} in BannerImageDeriver")
 
     def getSourceFiles(self):
-        return self.source.glob('*/*')
+        return self._iter_nested_source_entries()
 
     def getVariantsForImage(self, file, width, height):
-        subfolder = file.parts[0]
-        target_height = self.getHeightForType(subfolder)
+        big_height, big_height_2x = self.getScaledHeightsForType(file.parts[0])
         center = self.metadata['image_data'][file.name]['center']
         ret = []
-        for target_width in self.TARGET_WIDTHS:
-          big = [self.DENSITY*target_width, self.DENSITY*target_height]
-          if target_width*self.MIN_DPP_FOR_2X > width:
-            ret.append(ImageVariant(
-              "+delete mpr:orig "+magick_resize(
-                width, height,
-                round(big[0]), round(big[1]),
-                center[0], center[1]
-              ),
-              file.stem+f"-{target_width}-1x.webp"
-            ))
-            return ret
-          else:
-            ret.append(ImageVariant(
-              ("+delete mpr:orig " if ret else '')+magick_resize(
+        for target_width, big_width, big_width_2x in self.TARGET_SIZES:
+          only_1x = target_width*self.MIN_DPP_FOR_2X > width
+          # the biggest variant for each target_width is cropped from the original
+          ret.append(ImageVariant(
+            (('+delete', 'mpr:orig') if ret else ())+magick_resize(
               width, height,
-              round(2*big[0]), round(2*big[1]),
+              *((big_width, big_height) if only_1x else (big_width_2x, big_height_2x)),
               center[0], center[1]),
-              file.stem+f"-{target_width}-2x.webp"
-            ))
-            ret.append(ImageVariant(
-              f"-resize '{round(big[0])}x{round(big[1])}>'",
-              file.stem+f"-{target_width}-1x.webp"
-            ))
+            file.stem+f"-{target_width}-{'1x' if only_1x else '2x'}.webp"
+          ))
+          if only_1x:
+            return ret
+          ret.append(ImageVariant(
+            ('-resize', f'{big_width}x{big_height}>'),
+            file.stem+f"-{target_width}-1x.webp"
+          ))
         return ret
 
+async def run_derivers(derivers, copies=()):
+    """
+    Runs all the `derivers` at once (they work on disjoint directories)
+    sharing one semaphore to keep the total at args.cores ImageMagick processes
+
+    `copies` are (frompath, topath) pairs for copy_file, which run meanwhile
+    on worker threads (the hashing in files_match releases the GIL)
+    """
+    sem = asyncio.Semaphore(args.cores)
+    # one deriver failing doesn't stop the others from finishing (and writing their metadata)
+    await gather_all(
+        *(asyncio.to_thread(copy_file, frompath, topath) for frompath, topath in copies),
+        *(deriver.run(sem) for deriver in derivers))
+
 def write_modified_file_list(modified_files):
     dest = args.dest.resolve()
     flist = map(lambda f: str(f.relative_to(dest)), modified_files)
@@ -368,16 +793,29 @@ if __name__ == "__main__":
     global args 
     args = command_line_args()
     args.repo_dir = Path(sys.path[0])
+    # resolve once up front so touch_file can match paths without touching the disk
+    args.dest = args.dest.resolve()
     if args.verbose:
         print(f"Running with args: {args}\n")
+    magick_bin_error = check_magick_bin(BaseImageDeriver.MAGICK_BIN)
+    if magick_bin_error:
+        print(magick_bin_error)
+        exit(1)
+    if args.backend == 'vips' and pyvips is None:
+        print("--backend vips needs pyvips (pip install pyvips)")
+        exit(1)
     prepare_dest(args.dest, args.remove_old)
-    copy_file(args.repo_dir/'index.html', args.dest/'index.html')
-    modified_files = []
-    for deriverclass in [BuddhismCourseImageDeriver, FunctionCourseImageDeriver, ImageryCourseImageDeriver, TagIllustrationImageDeriver, BannerImageDeriver]:
-        deriver = deriverclass(
+    derivers = [
+        deriverclass(
           args.repo_dir, args.dest,
           verbose=args.verbose, dry_run=args.dry_run)
-        deriver.run()
+        for deriverclass in [BuddhismCourseImageDeriver, FunctionCourseImageDeriver, ImageryCourseImageDeriver, TagIllustrationImageDeriver, BannerImageDeriver]
+    ]
+    asyncio.run(run_derivers(derivers, copies=[
+        (args.repo_dir/'index.html', args.dest/'index.html'),
+    ]))
+    modified_files = []
+    for deriver in derivers:
         modified_files += deriver.modified_files
     if len(files_to_rm)>0:
       if args.verbose: